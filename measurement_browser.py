@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import contextlib
+import functools
+import gzip
 import json
 import math
-import re
+import queue
 import sqlite3
 import time
 
@@ -18,13 +20,16 @@ ALLOW_LIST = [
     'measurements.json'
 ]
 
+MEASUREMENT_TYPES = frozenset([
+    'temperature',
+    'humidity',
+    'pressure',
+    'battery_voltage',
+    'tx_power'
+])
 
-# https://stackoverflow.com/a/3300514
-def dict_factory(cursor, row):
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+SENSOR_CACHE_TTL_SECS = 60
+CONNECTION_POOL_SIZE = 4
 
 
 def stringify(v):
@@ -34,113 +39,66 @@ def stringify(v):
         return str(v)
 
 
-join_template = '''
-LEFT JOIN quantified_values AS {sensor_alias} ON
-    {sensor_alias}.sensor = '{sensor_id}'
-  AND
-    {sensor_alias}.recorded_at = quantified_values.recorded_at
-'''
-
 query_template = '''
-WITH
-  quantified_values AS (
-    SELECT CAST((recorded_at / 60) AS INTEGER) * 60 AS recorded_at, sensor, {measurement_type}
-    FROM measurement
-    WHERE recorded_at >= ? AND recorded_at < ?
-    GROUP BY CAST((recorded_at / 60) AS INTEGER) * 60, sensor
-  )
-
-SELECT DISTINCT
-  quantified_values.recorded_at,
+SELECT
+  CAST((recorded_at / 60) AS INTEGER) * 60 AS minute,
   {cols}
 
-FROM quantified_values
-
-{joins}
+FROM measurement
+WHERE recorded_at >= ? AND recorded_at < ?
+GROUP BY minute
+ORDER BY minute
 '''
 
 
-def create_sql(measurement_type, sensors):
-    col_template = '{sensor_alias}.{measurement_type}'
+@functools.lru_cache(maxsize=32)
+def create_sql(measurement_type, sensor_count):
+    # One column per sensor; the sensor ids are bound as parameters in the
+    # same order as the columns, followed by the time range. A sensor with
+    # several readings in a minute gets their average.
+    col_template = 'AVG(CASE WHEN sensor = ? THEN {measurement_type} END)'
 
     return query_template.format(
-        measurement_type=measurement_type,
         cols=',\n  '.join(
-            col_template.format(
-                sensor_alias='s' + str(idx),
-                measurement_type=measurement_type,
-            )
-            for idx, sensor in enumerate(sensors)
-        ),
-        joins=''.join(
-            join_template.format(
-                sensor_alias='s' + str(idx),
-                sensor_id=sensor
-            )
-            for idx, sensor in enumerate(sensors)
+            col_template.format(measurement_type=measurement_type)
+            for _ in range(sensor_count)
         )
     )
 
 
 def result_matrix_from_measurements(conn, sensors, start, end, measurement_type):
-    result = [[]]
-    for sensor in sensors:
-        result.append([])
+    if len(sensors) == 0:
+        return [[]]
 
-    for row in conn.execute(create_sql(measurement_type, sensors), (start, end)):
-        result[0].append(row[0])
-        for idx, value in enumerate(row[1:]):
-            result[idx + 1].append(value)
+    rows = conn.execute(create_sql(measurement_type, len(sensors)), (*sensors, start, end)).fetchall()
+    if len(rows) == 0:
+        return [[] for _ in range(len(sensors) + 1)]
 
-    return result
+    return [list(column) for column in zip(*rows)]
 
 
 def summary_table_name(measurement_type, period_secs):
     return f"summary_{measurement_type}_{period_secs}"
 
 
-summary_join_template = '''
-LEFT JOIN {table_name} AS {sensor_alias} ON
-    {sensor_alias}.sensor = '{sensor_id}'
-  AND
-    s.starts_at == {sensor_alias}.starts_at
-'''
-
 summary_query_template = '''
-SELECT
-  s.starts_at,
-  {cols}
-
-FROM {table_name} AS s
-{joins}
-WHERE
-  s.starts_at >= ? AND s.starts_at < ?
+SELECT starts_at, sensor, min_value, max_value, mean_value
+FROM {table_name}
+WHERE starts_at >= ? AND starts_at < ?
+ORDER BY starts_at
 '''
 
-def create_summary_sql(measurement_type, sensors, window_secs):
-    col_template = '{sensor_alias}.min_value, {sensor_alias}.max_value, {sensor_alias}.mean_value'
-    table_name = summary_table_name(measurement_type, window_secs)
+@functools.lru_cache(maxsize=32)
+def create_summary_sql(measurement_type, window_secs):
     return summary_query_template.format(
-        table_name=table_name,
-        cols=',\n  '.join(
-            col_template.format(
-                sensor_alias='s' + str(idx),
-                measurement_type=measurement_type,
-            )
-            for idx, sensor in enumerate(sensors)
-        ),
-        joins=''.join(
-            summary_join_template.format(
-                table_name=table_name,
-                sensor_alias='s' + str(idx),
-                sensor_id=sensor
-            )
-            for idx, sensor in enumerate(sensors)
-        )
+        table_name=summary_table_name(measurement_type, window_secs)
     )
 
 
 def result_matrix_from_summaries(conn, sensors, start, end, measurement_type, window):
+    # Each sensor gets three columns: min, max and mean.
+    sensor_columns = {sensor: 1 + idx * 3 for idx, sensor in enumerate(sensors)}
+
     result = [[]]
 
     for sensor in sensors:
@@ -148,20 +106,37 @@ def result_matrix_from_summaries(conn, sensors, start, end, measurement_type, wi
         result.append([])
         result.append([])
 
+    # The summarizer only creates tables for the types it summarizes, and
+    # only once it has run; until then there's simply nothing to show.
+    table_exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (summary_table_name(measurement_type, window),)).fetchone()
+    if table_exists is None:
+        return result
+
     now_epoch_secs = math.floor(time.time())
-    for row in conn.execute(create_summary_sql(measurement_type, sensors, window), (start, end)):
-        # Generally we want to show the summary as the end of the summary as
-        # it's basically looking back and summarizing that time. For the last
-        # summary, though, as it's basically to this current time, it makes
-        # more sense to limit it to current time.
-        summary_starts_at = row[0]
-        eff_summary_end = summary_starts_at + window
-        if now_epoch_secs < eff_summary_end:
-            eff_summary_end = now_epoch_secs
-
-        result[0].append(eff_summary_end)
-        for idx, value in enumerate(row[1:]):
-            result[idx + 1].append(value)
+    previous_starts_at = None
+    for summary_starts_at, sensor, min_value, max_value, mean_value in conn.execute(
+            create_summary_sql(measurement_type, window), (start, end)):
+        if summary_starts_at != previous_starts_at:
+            # Generally we want to show the summary as the end of the summary
+            # as it's basically looking back and summarizing that time. For
+            # the last summary, though, as it's basically to this current
+            # time, it makes more sense to limit it to current time.
+            eff_summary_end = summary_starts_at + window
+            if now_epoch_secs < eff_summary_end:
+                eff_summary_end = now_epoch_secs
+
+            result[0].append(eff_summary_end)
+            for column in result[1:]:
+                column.append(None)
+            previous_starts_at = summary_starts_at
+
+        column_idx = sensor_columns.get(sensor)
+        if column_idx is not None:
+            result[column_idx][-1] = min_value
+            result[column_idx + 1][-1] = max_value
+            result[column_idx + 2][-1] = mean_value
 
     return result
 
@@ -178,17 +153,65 @@ def resolve_window(start, end):
         return 86400
 
 
-measurement_type_matcher = re.compile(r'[a-z_]{1,20}')
-def json_query(parameters, file):
+def connect():
+    conn = sqlite3.connect('file:measurements.db?mode=ro', uri=True,
+                           detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                           check_same_thread=False)
+    # The browser only ever reads; map the file and keep a larger page cache
+    # so the range scans don't go through a read() call for every page.
+    conn.execute('PRAGMA mmap_size = 268435456')
+    conn.execute('PRAGMA cache_size = -65536')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+# Opening the database, setting it up and warming up the page cache is a
+# large part of a small query, so connections are kept around between
+# requests. Each one is only used by one request at a time.
+_connection_pool = queue.Queue(maxsize=CONNECTION_POOL_SIZE)
+@contextlib.contextmanager
+def pooled_connection():
+    try:
+        conn = _connection_pool.get_nowait()
+    except queue.Empty:
+        conn = connect()
+
+    try:
+        yield conn
+    finally:
+        try:
+            _connection_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+_sensor_cache = None
+def list_sensors(conn):
+    # SELECT DISTINCT sensor scans the whole measurement table and sensors
+    # come and go rarely, so the list is shared between requests for a while.
+    global _sensor_cache
+    now = time.monotonic()
+    if _sensor_cache is None or now - _sensor_cache[0] >= SENSOR_CACHE_TTL_SECS:
+        sensors = tuple(sorted(r[0] for r in conn.execute('SELECT DISTINCT sensor FROM measurement')))
+        _sensor_cache = (now, sensors)
+    return _sensor_cache[1]
+
+
+def parse_query(parameters):
     pd =  dict(parameters)
     start, end = int(pd['start']), int(pd['end'])
-    measurement_type = measurement_type_matcher.match(pd['measurementType']).group(0)
+    # The measurement type ends up in the SQL as a column name, so it must
+    # be one of the known ones exactly.
+    measurement_type = pd['measurementType']
+    if measurement_type not in MEASUREMENT_TYPES:
+        raise ValueError(f'unknown measurement type: {measurement_type!r}')
+    return start, end, measurement_type
+
 
-    with contextlib.closing(
-            sqlite3.connect('measurements.db',
-                            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)) as conn:
+def json_query(start, end, measurement_type):
+    with pooled_connection() as conn:
 
-        sensors = sorted(list(r[0] for r in conn.execute('SELECT DISTINCT sensor FROM measurement')))
+        sensors = list_sensors(conn)
 
         window = resolve_window(start, end)
         summaries = False
@@ -198,19 +221,44 @@ def json_query(parameters, file):
             matrix = result_matrix_from_summaries(conn, sensors, start, end, measurement_type, window)
             summaries = True
 
-        file.write(json.dumps(
-            {
-                'data': matrix,
-                'summaries': summaries,
-                'sensors': sensors
-            }
-        ).encode('utf-8'))
+    return json.dumps(
+        {
+            'data': matrix,
+            'summaries': summaries,
+            'sensors': sensors
+        },
+        # The matrix is nothing but numbers and separators; skip the
+        # whitespace the default separators would add to every value.
+        separators=(',', ':')
+    ).encode('utf-8')
 
 
 class MeasurementHandler(SimpleHTTPRequestHandler):
-    def do_GET(self, *args, **kwargs):
-        self.close_connection = True
+    # Keep connections open between the SPA's requests; every response
+    # carries a Content-Length, and idle connections are dropped after a
+    # while so they don't pile up.
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+
+    def accepts_gzip(self):
+        # Content-codings are case-insensitive, and q=0 means the coding is
+        # not acceptable. An explicit gzip entry takes precedence over '*'.
+        qvalues = {}
+        for encoding in self.headers.get('Accept-Encoding', '').split(','):
+            coding, *params = encoding.split(';')
+            q = 1.0
+            for param in params:
+                name, _, value = param.partition('=')
+                if name.strip().lower() == 'q':
+                    try:
+                        q = float(value.strip())
+                    except ValueError:
+                        q = 0.0
+            qvalues[coding.strip().lower()] = q
+
+        return qvalues.get('gzip', qvalues.get('*', 0.0)) > 0
 
+    def do_GET(self, *args, **kwargs):
         eff_path = self.path.replace('..', '')
         parsed = urlparse(eff_path)
 
@@ -219,16 +267,36 @@ class MeasurementHandler(SimpleHTTPRequestHandler):
             return self.send_error(403, message='Path not allowed', explain=None)
 
         if parsed.path.endswith('measurements.json'):
+            # The whole response is built before anything is sent so that a
+            # failing query doesn't leave the client with a truncated 200,
+            # and so the body can go out in one write with its length.
+            try:
+                start, end, measurement_type = parse_query(parse_qsl(parsed.query))
+            except (KeyError, ValueError) as e:
+                return self.send_error(400, message='Invalid query parameters', explain=str(e))
+
+            try:
+                payload = json_query(start, end, measurement_type)
+            except sqlite3.Error as e:
+                return self.send_error(500, message='Database query failed', explain=str(e))
+
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
+            if self.accepts_gzip():
+                # The matrices compress several times over; the lowest level
+                # gets most of that for little CPU on the Pi.
+                payload = gzip.compress(payload, compresslevel=1)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Length', str(len(payload)))
             self.end_headers()
-            json_query(parse_qsl(parsed.query), self.wfile)
+            self.wfile.write(payload)
             return
 
         return super().do_GET(*args, **kwargs)
 
 
-def run(server_class=HTTPServer, handler_class=MeasurementHandler):
+def run(server_class=ThreadingHTTPServer, handler_class=MeasurementHandler):
     server_address = ('', 8000)
     httpd = server_class(server_address, handler_class)
     httpd.serve_forever()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import contextlib
+import functools
 import re
 import sqlite3
 import time
@@ -15,6 +16,7 @@ def table_name(measurement_type, period_secs):
     return f"summary_{measurement_type}_{period_secs}"
 
 
+@functools.lru_cache(maxsize=32)
 def create_sql(measurement_type, period_secs):
     return f"""CREATE TABLE IF NOT EXISTS {table_name(measurement_type, period_secs)} (
   starts_at INTEGER NOT NULL,
@@ -28,41 +30,107 @@ def create_sql(measurement_type, period_secs):
 """
 
 
-def summarize_period_containing(conn, measurement_type, period_secs, containing_epoch_secs, overwrite=False):
-    period_start = containing_epoch_secs - (containing_epoch_secs % period_secs)
+# The statements below are run for every period and sensor; they only depend
+# on the measurement type and period, so they are built once.
 
-    sensors = list(r[0] for r in conn.execute('SELECT DISTINCT sensor FROM measurement'))
+@functools.lru_cache(maxsize=32)
+def summarized_sensors_sql(measurement_type, period_secs):
+    return f'SELECT sensor FROM {table_name(measurement_type, period_secs)} WHERE starts_at = ?'
 
-    for sensor in sensors:
-        if len(conn.execute(f'SELECT 1 FROM {table_name(measurement_type, period_secs)} WHERE starts_at = ? AND sensor = ?', (period_start, sensor)).fetchall()) == 1:
-            if overwrite is False:
-                continue
 
-        values = list(r[0] for r in conn.execute(f"SELECT {measurement_type} FROM measurement WHERE sensor = ? AND recorded_at >= ? AND recorded_at < ?", (sensor, period_start, period_start + period_secs)))
+@functools.lru_cache(maxsize=32)
+def aggregate_sql(measurement_type):
+    return f"""
+SELECT sensor, COUNT({measurement_type}), MIN({measurement_type}), MAX({measurement_type}), AVG({measurement_type})
+FROM measurement
+WHERE recorded_at >= ? AND recorded_at < ?
+GROUP BY sensor"""
 
-        if len(values) == 0:
-            logger.debug(f'No {measurement_type} values for {sensor} starting {period_start}, period {period_secs}')
-            continue
 
-        values.sort()
+@functools.lru_cache(maxsize=32)
+def median_sql(measurement_type):
+    return f"""
+SELECT {measurement_type}
+FROM measurement
+WHERE sensor = ? AND recorded_at >= ? AND recorded_at < ? AND {measurement_type} IS NOT NULL
+ORDER BY {measurement_type}
+LIMIT 1 OFFSET ?"""
+
 
-        conn.execute(
-            f"""
+@functools.lru_cache(maxsize=32)
+def insert_sql(measurement_type, period_secs):
+    return f"""
 INSERT OR REPLACE INTO {table_name(measurement_type, period_secs)}
   (starts_at, sensor, min_value, max_value, median_value, mean_value)
 VALUES
-  (?, ?, ?, ?, ?, ?)""", (
-      period_start,
-      sensor,
-      values[0],
-      values[-1],
-      values[int(len(values) / 2.0)],
-      sum(values) / float(len(values))))
+  (?, ?, ?, ?, ?, ?)"""
 
-        conn.commit()
+
+def connect():
+    conn = sqlite3.connect('measurements.db',
+                           detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    # In WAL mode the collector's writes don't block readers (the browser,
+    # this script) and vice versa. The mode sticks to the database file.
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+    except sqlite3.OperationalError as e:
+        # Changing the mode needs the database to itself; try again next run.
+        logger.warning('Could not switch to WAL mode: %s', e)
+
+    # With WAL, NORMAL only fsyncs at checkpoints and can't corrupt the
+    # database; a crash may just lose the last summaries, which get redone.
+    # With a rollback journal it isn't power-loss safe, so keep the default.
+    journal_mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+    if journal_mode.lower() == 'wal':
+        conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+def create_indexes(conn):
+    # Summarization looks up one sensor's values over a time range at a time,
+    # which the (recorded_at, sensor) primary key can't seek on by itself.
+    conn.execute('CREATE INDEX IF NOT EXISTS measurement_sensor_recorded_at_idx ON measurement (sensor, recorded_at)')
+    conn.commit()
+
+
+def summarize_period_containing(conn, measurement_type, period_secs, containing_epoch_secs, overwrite=False):
+    period_start = containing_epoch_secs - (containing_epoch_secs % period_secs)
+
+    summarized_sensors = set()
+    if overwrite is False:
+        summarized_sensors = set(r[0] for r in conn.execute(summarized_sensors_sql(measurement_type, period_secs), (period_start,)))
+
+    # One pass over the period for every sensor's aggregates; only the median
+    # needs a second, ordered lookup per sensor.
+    summaries = []
+    for sensor, count, min_value, max_value, mean_value in conn.execute(
+            aggregate_sql(measurement_type), (period_start, period_start + period_secs)).fetchall():
+        if sensor in summarized_sensors:
+            continue
+
+        if count == 0:
+            # Formatted lazily, as this is hit for every sensor lacking a
+            # measurement type (e.g. pressure) and debug logging is usually off.
+            logger.debug('No %s values for %s starting %s, period %s', measurement_type, sensor, period_start, period_secs)
+            continue
+
+        median_value = conn.execute(
+            median_sql(measurement_type),
+            (sensor, period_start, period_start + period_secs, count // 2)).fetchone()[0]
+
+        summaries.append((
+            period_start,
+            sensor,
+            min_value,
+            max_value,
+            median_value,
+            mean_value))
+
+    return summaries
 
 
 def summarize_single_period(conn, period_secs, epoch_secs_containing, overwrite=False):
+        summaries = []
         for measurement_type in [
                 'temperature',
                 'humidity',
@@ -71,19 +139,35 @@ def summarize_single_period(conn, period_secs, epoch_secs_containing, overwrite=
                 # 'tx_power'
         ]:
             conn.execute(create_sql(measurement_type, period_secs))
-            summarize_period_containing(conn, measurement_type, period_secs, epoch_secs_containing, overwrite=overwrite)
+            rows = summarize_period_containing(conn, measurement_type, period_secs, epoch_secs_containing, overwrite=overwrite)
+            summaries.append((measurement_type, period_secs, rows))
+        return summaries
+
+
+def store_summaries(conn, summaries):
+    # The collector can't write while this transaction is open, so it only
+    # covers the inserts; the summaries are all computed beforehand.
+    for measurement_type, period_secs, rows in summaries:
+        # Even an empty executemany would open a transaction.
+        if rows:
+            conn.executemany(insert_sql(measurement_type, period_secs), rows)
+    conn.commit()
 
 
 def summarize_latest(conn, args):
-    summarize_single_period(conn, 3600, int(time.time()), overwrite=True)
-    summarize_single_period(conn, 10800, int(time.time()), overwrite=True)
-    summarize_single_period(conn, 86400, int(time.time()), overwrite=True)
+    summaries = []
+    summaries += summarize_single_period(conn, 3600, int(time.time()), overwrite=True)
+    summaries += summarize_single_period(conn, 10800, int(time.time()), overwrite=True)
+    summaries += summarize_single_period(conn, 86400, int(time.time()), overwrite=True)
+    store_summaries(conn, summaries)
 
 
 def summarize_previous(conn, args):
-    summarize_single_period(conn, 3600, int(time.time()) - 3600, overwrite=True)
-    summarize_single_period(conn, 10800, int(time.time()) - 10800, overwrite=True)
-    summarize_single_period(conn, 86400, int(time.time()) - 8600, overwrite=True)
+    summaries = []
+    summaries += summarize_single_period(conn, 3600, int(time.time()) - 3600, overwrite=True)
+    summaries += summarize_single_period(conn, 10800, int(time.time()) - 10800, overwrite=True)
+    summaries += summarize_single_period(conn, 86400, int(time.time()) - 8600, overwrite=True)
+    store_summaries(conn, summaries)
 
 
 def summarize_since(conn, args):
@@ -95,15 +179,27 @@ def summarize_since(conn, args):
 
     arg_pairs.sort(key=lambda x: x[1], reverse=True)
 
-    started_at = dt.datetime.now()
+    batch_size = 100
+    started_at = time.monotonic()
+    summaries = []
     for index, pair in enumerate(arg_pairs):
-        time_taken = (dt.datetime.now() - started_at).total_seconds()
-        avg_time_per_item = time_taken / float(index + 1)
-        time_to_go = (len(arg_pairs) - index) * avg_time_per_item
-
         period_secs, e = pair
-        logger.info(f'Summarizing ({period_secs}, {e}), taken: {time_taken}s, to go: {time_to_go}s')
-        summarize_single_period(conn, period_secs, e)
+        logger.debug('Summarizing (%s, %s)', period_secs, e)
+        summaries += summarize_single_period(conn, period_secs, e)
+
+        # Store and report progress in batches of periods; committing every
+        # period makes a long backfill mostly wait for the disk. Only the
+        # inserts are in the transaction, so the collector isn't held up by
+        # the batch's reads.
+        done = index + 1
+        if done % batch_size == 0 or done == len(arg_pairs):
+            store_summaries(conn, summaries)
+            summaries = []
+
+            time_taken = time.monotonic() - started_at
+            avg_time_per_item = time_taken / float(done)
+            time_to_go = (len(arg_pairs) - done) * avg_time_per_item
+            logger.info('Summarized %s/%s periods, taken: %.1fs, to go: %.1fs', done, len(arg_pairs), time_taken, time_to_go)
 
 
 def clear_summaries(conn, args):
@@ -149,7 +245,12 @@ if __name__ == '__main__':
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
-    with contextlib.closing(
-            sqlite3.connect('measurements.db',
-                            detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)) as conn:
+    with contextlib.closing(connect()) as conn:
+        # Building the index holds the write lock, so don't make the
+        # collector wait for it when the measurements aren't even read.
+        if args.func is not clear_summaries:
+            create_indexes(conn)
         args.func(conn, args)
+        # Keeps the planner statistics (e.g. for picking between the primary
+        # key and the sensor index) up to date; cheap when nothing changed.
+        conn.execute('PRAGMA optimize')